@@ -5,50 +5,184 @@ Analyze and visualize graphs: clustering, overlap, communities, homophily,
 balance, failures, robustness, and temporal evolution.
 """
 
-import argparse, csv, math, os, random, sys
+import argparse, contextlib, math, os, re, sys
 from collections import deque
-from datetime import datetime
-import matplotlib.pyplot as plt, networkx as nx, numpy as np
-from networkx.algorithms.community import girvan_newman
+import matplotlib.pyplot as plt, networkx as nx, numpy as np, pandas as pd
+from joblib import Parallel, delayed
 from scipy.stats import ttest_ind
-import scipy.stats
+import scipy.sparse, scipy.sparse.csgraph
+try: from numba import njit
+except ImportError: njit=None
+
+def _no_jit(*a,**k): return a[0] if a and callable(a[0]) else _no_jit
+if njit is None: njit=_no_jit
 
 def eprint(*x): print(*x, file=sys.stderr)
 
+_GML_TOKEN=re.compile(r'#[^\n]*|"[^"]*"|[\[\]]|[^\s\[\]"]+')
+
+def _gml_scan(text):
+    # what igraph can't reproduce: nested lists below graph/node/edge, empty strings (igraph's
+    # "missing" marker), multigraph/directed headers, and which keys hold int vs float literals
+    nested=special=False; ints,floats=set(),set(); stack=[]
+    toks=(t for t in _GML_TOKEN.findall(text) if not t.startswith('#'))
+    for key in toks:
+        if key==']':
+            if stack: stack.pop()
+            continue
+        val=next(toks,None)
+        if val is None: break
+        if val=='[':
+            if stack and not (len(stack)==1 and key in ('node','edge')): nested=True
+            stack.append(key)
+        elif val=='""': special=True
+        elif len(stack)==1 and key in ('directed','multigraph') and val!='0': special=True
+        elif not val.startswith('"'):
+            try: int(val); ints.add(key)
+            except ValueError: floats.add(key)
+    return nested or special,ints,floats
+
+def _gml_attrs(d, floats, skip=()):
+    # igraph reads every number as float and fills missing attributes with ''/nan
+    out={}
+    for k,x in d.items():
+        if k in skip or x is None or x=='' or (isinstance(x,float) and math.isnan(x)): continue
+        out[k]=int(x) if isinstance(x,float) and x.is_integer() and k not in floats else x
+    return out
+
+def _read_gml(path):
+    try: import igraph as ig
+    except ImportError: return nx.read_gml(path)
+    with open(path) as f: nested,ints,floats=_gml_scan(f.read())
+    # nested/empty-string attributes, multigraph or directed files, or keys holding both int and
+    # float literals only round-trip through networkx
+    if nested or ints&floats: return nx.read_gml(path)
+    g=ig.Graph.Read_GML(path)
+    if 'label' not in g.vs.attributes(): return nx.read_gml(path)
+    names=[_gml_attrs({'label':x},floats).get('label') for x in g.vs['label']]
+    ends=[(e.source,e.target) if g.is_directed() else tuple(sorted(e.tuple)) for e in g.es]
+    # missing or duplicate labels and duplicate edges: let networkx raise (or build a multigraph)
+    if None in names or len(set(names))<len(names) or len(set(ends))<len(ends): return nx.read_gml(path)
+    G=nx.DiGraph() if g.is_directed() else nx.Graph()
+    G.graph.update(_gml_attrs({k:g[k] for k in g.attributes()},floats,('directed','multigraph')))
+    G.add_nodes_from((names[v.index],_gml_attrs(v.attributes(),floats,('id','label'))) for v in g.vs)
+    G.add_edges_from((names[e.source],names[e.target],_gml_attrs(e.attributes(),floats)) for e in g.es)
+    return G
+
 def load_graph(path):
     if not os.path.exists(path): raise FileNotFoundError(path)
-    G = nx.read_gml(path)
+    G = _read_gml(path)
     if G.is_directed(): 
         G = nx.Graph(G)
     if G.number_of_nodes()==0: eprint('[warn] Empty graph')
     return G
 
 
+def _csr(G,signed=False):
+    # node order plus CSR (indptr, indices, data) of G's current edges; data holds the +1/-1
+    # signs only when signed, so callers that don't need them never parse 'sign'
+    nodes=list(G); idx={x:i for i,x in enumerate(nodes)}; n=len(nodes)
+    r,cols,d=[],[],[]
+    edges=G.edges(data='sign',default=1) if signed else ((u,v,1) for u,v in G.edges())
+    for u,v,sg in edges:
+        w=1 if int(sg)>=0 else -1; i,j=idx[u],idx[v]
+        r.append(i); cols.append(j); d.append(w)
+        if i!=j: r.append(j); cols.append(i); d.append(w)
+    A=scipy.sparse.csr_array((np.array(d,np.int8),(np.array(r,np.int32),np.array(cols,np.int32))),shape=(n,n))
+    A.sort_indices()
+    return nodes,A.indptr,A.indices,A.data
+
+def _square(csr):
+    # adjacency (self-loops dropped), its square and degrees from a _csr() build: shared by clustering and overlap
+    nodes,indptr,indices,_=csr; n=len(nodes)
+    A=scipy.sparse.csr_array((np.ones(len(indices),np.int32),indices,indptr),shape=(n,n),copy=True)
+    A.setdiag(0); A.eliminate_zeros()
+    return nodes,A,A@A,np.asarray(A.sum(axis=1)).ravel()
+
+def _set_cc(G,nodes,A,A2,deg):
+    # row sums of A*(A@A) are the diagonal of A^3, i.e. twice the triangles
+    tri=np.asarray(A.multiply(A2).sum(axis=1)).ravel()/2
+    cc=np.where(deg>1,2*tri/np.maximum(deg*(deg-1),1),0.0)
+    nx.set_node_attributes(G,dict(zip(nodes,cc.tolist())),'cc')
+
+def _set_no(G,nodes,A2,deg):
+    idx={n:i for i,n in enumerate(nodes)}; edges=list(G.edges())
+    if not edges: return
+    E=np.array([(idx[u],idx[v]) for u,v in edges])
+    loop=np.zeros(len(nodes),np.int64)
+    for x in nx.nodes_with_selfloops(G): loop[idx[x]]=1
+    common=np.asarray(A2[E[:,0],E[:,1]]).ravel()
+    # A has no self-loops, but N(u)-{v} still contains u when u has one: it only widens the union
+    denom=deg[E[:,0]]+deg[E[:,1]]-2-common+loop[E[:,0]]+loop[E[:,1]]
+    no=np.where(denom>0,common/np.maximum(denom,1),0.0)
+    # a self-loop (u,u) compares N(u)-{u} with itself
+    no=np.where(E[:,0]==E[:,1],(deg[E[:,0]]>0).astype(float),no)
+    for (u,v),x in zip(edges,no.tolist()): G[u][v]['no']=x
+
 def clustering(G):
-    cc=nx.clustering(G)
-    nx.set_node_attributes(G,cc,'cc')
+    if G.number_of_nodes()==0: return
+    nodes,A,A2,deg=_square(_csr(G)); _set_cc(G,nodes,A,A2,deg)
 
 def overlap(G):
-    data={}
-    for u,v in G.edges():
-        Nu,Nv=set(G.neighbors(u))- {v}, set(G.neighbors(v))- {u}
-        d=len(Nu|Nv)
-        if d==0:
-            data[(u,v)]=0 
-        else:
-            data[(u,v)]=len(Nu&Nv)/d
-    nx.set_edge_attributes(G,{tuple(sorted([u,v])):{'no':data[(u,v)]} for u,v in G.edges()})
+    if G.number_of_nodes()==0: return
+    nodes,A,A2,deg=_square(_csr(G)); _set_no(G,nodes,A2,deg)
+
+def _analyze(G):
+    # clustering + overlap from one CSR build and a single A@A product
+    if G.number_of_nodes()==0: return
+    nodes,A,A2,deg=_square(_csr(G))
+    _set_cc(G,nodes,A,A2,deg); _set_no(G,nodes,A2,deg)
 
 def components(G,n, robustnessK=0):
-    G.remove_edges_from(random.sample(list(G.edges()), robustnessK))
+    G.remove_edges_from(_sample_edges(G,robustnessK))
     parts=girvan_newman_partition(G,n)
     annotate(G,parts)
     return G, parts
 
+def _ebc(H):
+    # raw betweenness decomposes across components, so each one is scored alone
+    return nx.edge_betweenness_centrality(H,normalized=False)
+
+def _sub(g,c):
+    # ordered copy of g restricted to c; subgraph views iterate the (unordered) node set
+    nodes=[x for x in g if x in c]
+    H=nx.Graph(); H.add_nodes_from(nodes); H.add_edges_from(g.edges(nodes)); return H
+
+_PARALLEL_MIN_EDGES=2000
+
+def _gn(G):
+    g=G.copy(); g.remove_edges_from(list(nx.selfloop_edges(g)))
+    num_edges=g.number_of_edges()
+    if num_edges==0:
+        yield tuple(nx.connected_components(g)); return
+    with contextlib.ExitStack() as stack:
+        par=[]
+        def score(parts):
+            # worker dispatch only pays off for several sizeable pieces; the pool is opened on first use
+            subs=[_sub(g,c) for c in parts]
+            if len(subs)==1 or sum(H.number_of_edges() for H in subs)<_PARALLEL_MIN_EDGES:
+                return [_ebc(H) for H in subs]
+            if not par: par.append(stack.enter_context(Parallel(n_jobs=-1)))
+            return par[0](delayed(_ebc)(H) for H in subs)
+        comps=[frozenset(c) for c in nx.connected_components(g)]
+        bc_cache=dict(zip(comps,score(comps)))
+        while num_edges>0:
+            ncomp=len(bc_cache)
+            while len(bc_cache)<=ncomp and num_edges>0:
+                c=max((c for c in bc_cache if bc_cache[c]),key=lambda c:max(bc_cache[c].values()))
+                bc=bc_cache.pop(c); g.remove_edge(*max(bc,key=bc.get)); num_edges-=1
+                parts=[frozenset(p) for p in nx.connected_components(g.subgraph(c))]
+                bc_cache.update(zip(parts,score(parts)))
+            yield tuple(nx.connected_components(g))
+
 def girvan_newman_partition(G,n):
-    gen=girvan_newman(G)
-    for x in range(n): 
-        comp=next(gen)
+    # already split into enough pieces: the components are the partition, skip betweenness
+    ccs=list(nx.connected_components(G))
+    if len(ccs)>=n: return tuple(sorted(ccs,key=len,reverse=True))
+    # otherwise split until there are at least n communities (or no edges are left)
+    comp=tuple(ccs)
+    for comp in _gn(G):
+        if len(comp)>=n: break
     return comp
 
 def annotate(G, parts):
@@ -59,65 +193,135 @@ def annotate(G, parts):
     nx.set_node_attributes(G, d, 'community')
 
 def homophily(G):
-    same,diff=[],[]
-    for u,v in G.edges():
-        cu,cv=G.nodes[u].get('color'),G.nodes[v].get('color')
-        if cu is None or cv is None: 
-            continue
-        sim= 1/(1+abs(G.degree(u)-G.degree(v)))
-        if cu == cv:
-            same.append(sim)
-        else:
-            diff.append(sim)
+    nodes=list(G); idx={n:i for i,n in enumerate(nodes)}
+    colors=np.array([G.nodes[n].get('color') for n in nodes],dtype=object)
+    deg=np.array([d for _,d in G.degree(nodes)],np.int32)
+    E=np.fromiter((idx[x] for uv in G.edges() for x in uv),np.int32).reshape(-1,2)
+    cu,cv=colors[E[:,0]],colors[E[:,1]]
+    sim=1.0/(1.0+np.abs(deg[E[:,0]]-deg[E[:,1]]))
+    valid=(cu!=None)&(cv!=None); mask=cu==cv
+    same,diff=sim[mask&valid],sim[~mask&valid]
     if len(same)<2 or len(diff)<2: 
         return {'error':'not enough data'}
     t,p=ttest_ind(same,diff,equal_var=False)
-    d = scipy.stats.cohen_d(same,diff).cohen_d
-    return {'t':round(t,3),'p':round(p,4),'d':round(d,3)}
+    n1,n2=len(same),len(diff)
+    sp=math.sqrt(((n1-1)*same.var(ddof=1)+(n2-1)*diff.var(ddof=1))/(n1+n2-2))
+    d=(same.mean()-diff.mean())/sp if sp>0 else 0.0
+    return {'t':round(float(t),3),'p':round(float(p),4),'d':round(float(d),3)}
+
+@njit(cache=True)
+def _balance(indptr,indices,signs,n):
+    label=np.zeros(n,np.int8); stack=np.empty(n,np.int32)
+    for s in range(n):
+        if label[s]!=0: continue
+        label[s]=1; top=0; stack[0]=s; top=1
+        while top>0:
+            top-=1; u=stack[top]
+            for k in range(indptr[u],indptr[u+1]):
+                v=indices[k]; exp=label[u]*signs[k]
+                if label[v]==0:
+                    label[v]=exp; stack[top]=v; top+=1
+                elif label[v]!=exp:
+                    return False
+    return True
 
 def balance(G):
+    if njit is not _no_jit:
+        nodes,indptr,indices,signs=_csr(G,signed=True)
+        return bool(_balance(indptr,indices,signs,len(nodes)))
+    # without numba: DFS with a list stack over G._adj (visit order doesn't matter for two-coloring)
     label={}
     for s in G.nodes():
         if s in label: continue
-        label[s]=1; q=deque([s])
-        while q:
-            u=q.popleft()
-            for v in G.neighbors(u):
-                sign=int(G[u][v].get('sign',1))
+        label[s]=1; stack=[s]
+        while stack:
+            u=stack.pop()
+            for v,ed in G._adj[u].items():
+                sign=int(ed.get('sign',1))
                 exp=label[u]* (1 if sign>=0 else -1)
                 if v not in label:
                     label[v]=exp
-                    q.append(v)
+                    stack.append(v)
                 elif label[v]!=exp: 
                     return False
     return True
 
+def _components(G):
+    # one BFS labeling pass returning component sizes and the largest component's nodes
+    sizes=[]; seen=set(); lcc=set()
+    for s in G:
+        if s in seen: continue
+        comp={s}; q=deque([s])
+        while q:
+            for v in G._adj[q.popleft()]:
+                if v not in comp: comp.add(v); q.append(v)
+        seen|=comp; sizes.append(len(comp))
+        if len(comp)>len(lcc): lcc=comp
+    return sizes,lcc
+
+_APSP_BLOCK=1<<22
+
 def stats(G):
-    comps=[G.subgraph(c).copy() for c in nx.connected_components(G)]
-    if not comps: return {'aspl':None,'n':0,'sizes':[]}
-    LCC=max(comps,key=lambda H:H.number_of_nodes())
-    asp=nx.average_shortest_path_length(LCC) if LCC.number_of_edges()>0 else None
-    return {'aspl':asp,'n':len(comps),'sizes':[len(c) for c in comps]}
+    sizes,lcc=_components(G)
+    if not sizes: return {'aspl':None,'n':0,'sizes':[]}
+    asp=None
+    if len(lcc)>1:
+        A=nx.to_scipy_sparse_array(G.subgraph(lcc),weight=None,format='csr'); n=A.shape[0]
+        # BFS from a block of sources at a time so only a block x n distance matrix is alive
+        blk=max(1,_APSP_BLOCK//n); total=0.0; count=0
+        for i in range(0,n,blk):
+            D=scipy.sparse.csgraph.shortest_path(A,unweighted=True,directed=False,indices=np.arange(i,min(i+blk,n)))
+            D=D[np.isfinite(D)&(D>0)]; total+=D.sum(); count+=D.size
+        asp=float(total/count) if count else None
+    return {'aspl':asp,'n':len(sizes),'sizes':sizes}
+
+def _sample_edges(G,k):
+    edges_np=np.fromiter(G.edges(),dtype=object,count=G.number_of_edges())
+    return edges_np[np.random.choice(len(edges_np),min(k,len(edges_np)),replace=False)]
 
 def simulate_failures(G,k):
     before=stats(G)
-    H=G.copy(); edges=list(G.edges()); rem=random.sample(edges,min(k,len(edges)))
-    H.remove_edges_from(rem); after=stats(H)
+    H=G.copy(); H.remove_edges_from(_sample_edges(G,k)); after=stats(H)
     return before,after
 
+@njit(cache=True)
+def _count_components(n,src,dst):
+    parent=np.arange(n); count=n
+    for k in range(len(src)):
+        a=src[k]
+        while parent[a]!=a: parent[a]=parent[parent[a]]; a=parent[a]
+        b=dst[k]
+        while parent[b]!=b: parent[b]=parent[parent[b]]; b=parent[b]
+        if a!=b: parent[a]=b; count-=1
+    return count
+
 def robustness(G,k,trials,parts=None):
+    # only the component count is needed, so mask edges and union-find instead of copying G
+    nodes,indptr,indices,_=_csr(G); n=len(nodes)
+    rows=np.repeat(np.arange(n),np.diff(indptr)); up=rows<=indices
+    edges=np.stack([rows[up],indices[up]],axis=1).astype(np.int64); m=len(edges)
     res=[]
     for _ in range(trials):
-        H=G.copy(); H.remove_edges_from(random.sample(list(H.edges()),min(k,H.number_of_edges())))
-        s=stats(H); res.append(s['n'])
+        keep=np.ones(m,bool); keep[np.random.choice(m,min(k,m),replace=False)]=False
+        E=edges[keep]; res.append(_count_components(n,E[:,0],E[:,1]))
     return {'avg_comp':np.mean(res) if res else 0}
 
+def layout(G):
+    # spring layout cached on G; nodes added since the last call are placed from the old positions
+    pos=G.graph.get('_pos')
+    if pos is None or any(n not in pos for n in G):
+        init={n:p for n,p in (pos or {}).items() if n in G} or None
+        pos=nx.spring_layout(G,pos=init,iterations=20 if len(G)>500 else 50,seed=42)
+        G.graph['_pos']=pos
+    return pos
+
 def plot_graph(G,mode,out=None):
-    pos=nx.spring_layout(G); plt.figure(figsize=(8,6))
+    pos=layout(G); plt.figure(figsize=(8,6))
     if mode=='C':
-        clustering(G); c=[G.degree(n) for n in G]
-        s=[300+2000*G.nodes[n].get('cc',0) for n in G]
-        nx.draw(G,pos,node_size=s,node_color=c,cmap=plt.cm.cool,with_labels=True)
+        clustering(G); nodes=list(G)
+        deg=np.fromiter((d for _,d in G.degree(nodes)),np.int32,len(nodes))
+        cc=np.fromiter((G.nodes[n].get('cc',0.0) for n in nodes),np.float64,len(nodes))
+        nx.draw(G,pos,nodelist=nodes,node_size=300+2000*cc,node_color=deg,cmap=plt.cm.cool,with_labels=True)
     elif mode=='N':
         overlap(G); w=[1+6*G[u][v]['no'] for u,v in G.edges()]
         nx.draw(G,pos,with_labels=True,width=w,edge_color='gray')
@@ -130,28 +334,54 @@ def plot_graph(G,mode,out=None):
     else: plt.show(); plt.close()
 
 def export_graph(G,out):
-    nx.write_gml(G,out)
+    H=G.copy()
+    for k in [k for k in H.graph if k.startswith('_')]: del H.graph[k]
+    nx.write_gml(H,out)
 
 def parse_csv(path):
-    ev=[]
-    with open(path) as f:
-        for r in csv.DictReader(f):
-            t=datetime.fromisoformat(r['timestamp']).timestamp()
-            ev.append((t,r['source'],r['target'],r['action'].lower()))
-    return sorted(ev)
-
-def temporal(G,path,out=None):
-    ev=parse_csv(path); pos=nx.spring_layout(G); snaps=[]
-    for _,u,v,a in ev:
-        if a=='add': G.add_edge(u,v)
-        elif a=='remove' and G.has_edge(u,v): G.remove_edge(u,v)
-        snaps.append(G.copy())
+    df=pd.read_csv(path,dtype={'source':str,'target':str,'action':str})
+    ts=pd.to_datetime(df['timestamp'],format='ISO8601',utc=True)
+    df['t']=ts.values.astype('datetime64[ns]').astype('int64')/1e9
+    df['action']=df['action'].str.lower()
+    df=df.sort_values(['t','source','target','action'],kind='stable')
+    return list(df[['t','source','target','action']].itertuples(index=False,name=None))
+
+def _apply_event(G,e):
+    _,u,v,a=e
+    if a=='add': G.add_edge(u,v)
+    elif a=='remove' and G.has_edge(u,v): G.remove_edge(u,v)
+
+def temporal(G,path,out=None,every=50):
+    ev=parse_csv(path); pos=layout(G)
     if out:
-        import matplotlib.animation as animation
-        fig=plt.figure(figsize=(8,6))
-        def upd(i): plt.clf(); nx.draw(snaps[i],pos,node_size=100,width=0.8)
-        ani=animation.FuncAnimation(fig,upd,frames=len(snaps),interval=500)
+        import matplotlib, matplotlib.animation as animation
+        from matplotlib.collections import LineCollection
+        matplotlib.use('Agg')
+        # replay events into one graph per frame; keep a copy every `every` events for seeking back
+        H=G.copy(); cur=-1; ckpt={-1:G.copy()}
+        fig,ax=plt.subplots(figsize=(8,6)); ax.set_axis_off()
+        xy=np.array(list(pos.values())).reshape(-1,2)
+        if len(xy):
+            pad=0.05*max(np.ptp(xy[:,0]),np.ptp(xy[:,1]),1e-9)
+            ax.set_xlim(xy[:,0].min()-pad,xy[:,0].max()+pad); ax.set_ylim(xy[:,1].min()-pad,xy[:,1].max()+pad)
+        # one edge collection and one node scatter, mutated per frame instead of redrawn
+        ecoll=LineCollection([],colors='k',linewidths=0.8,zorder=1); ax.add_collection(ecoll)
+        nodes=ax.scatter([],[],s=100,c='#1f78b4',zorder=2)
+        def draw(H):
+            nodes.set_offsets(np.array([pos[n] for n in H]).reshape(-1,2))
+            ecoll.set_segments([(pos[u],pos[v]) for u,v in H.edges()])
+            return nodes,ecoll
+        def upd(i):
+            nonlocal H,cur
+            if i<cur:
+                cur=max(c for c in ckpt if c<=i); H=ckpt[cur].copy()
+            for j in range(cur+1,i+1):
+                _apply_event(H,ev[j])
+                if (j+1)%every==0 and j not in ckpt: ckpt[j]=H.copy()
+            cur=i; return draw(H)
+        ani=animation.FuncAnimation(fig,upd,frames=len(ev),init_func=lambda:draw(H),interval=500,blit=True)
         ani.save(out,writer='pillow',dpi=120); eprint(f'GIF saved {out}')
+    for e in ev: _apply_event(G,e)
     return len(ev)
 
 def main():
@@ -164,7 +394,7 @@ def main():
     a=p.parse_args()
 
     G=load_graph(a.graph); eprint(f'Loaded {G.number_of_nodes()} nodes, {G.number_of_edges()} edges')
-    clustering(G); overlap(G)
+    _analyze(G)
 
     if a.components: parts=girvan_newman_partition(G,a.components); annotate(G,parts); eprint(f'Communities: {len(parts)}')
     if a.plot: plot_graph(G,a.plot,a.plot_out)